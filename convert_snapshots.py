@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+# Converts the GPFS mmrepquota and VAST quota snapshots into the columnar form getquota.py
+# and the admin reports read. Run from cron after the snapshots are updated.
+import sys
+
+import getquota
+
+if getquota.numpy is None:
+    sys.exit('numpy is required to convert snapshots')
+
+snapshots = []
+for filesystem in sorted(set(getquota.gpfs_device_names.values())):
+    snapshots.append(('/gpfs/'+filesystem + '/.mmrepquota/current', filesystem, getquota.gpfs_quota_records))
+for filesystem in getquota.vast_paths.keys():
+    for filename in ['current', 'mccleary_current', 'grace_current']:
+        snapshots.append((getquota.vast_paths[filesystem] + '.quotas/'+filename, filesystem,
+                          getquota.vast_quota_records))
+
+for filename, filesystem, records in snapshots:
+    filename = getquota.snapshot_path(filename)
+    if filename is None:
+        continue
+
+    # only convert snapshots that changed since the last run
+    if getquota.load_columnar_snapshot(filename) is not None:
+        continue
+
+    print(filename)
+    getquota.write_columnar_snapshot(filename, records(filename, filesystem))
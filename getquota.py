@@ -1,21 +1,46 @@
 #!/usr/bin/env python3
+import codecs
+import contextlib
+import ctypes
+import ctypes.util
 import fcntl
 import getpass
 import grp
+import gzip
+import heapq
+import io
 import os
 import pickle
 import json
 import pwd
+import queue
 import re
+import select
 import shlex
+import shutil
 import stat
+import struct
 import subprocess
 import argparse
 import sys
+import tempfile
+import threading
 import time
 from datetime import datetime
 from threading import Timer
 
+# optional, only needed for the columnar snapshots written by convert_snapshots.py
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# optional, without it zstd compressed snapshots are read through the zstd command
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 gpfs_device_names = {'gibbs': 'gibbs',
                      'milgram': 'milgram',
                      'ycga': 'ycga',
@@ -28,16 +53,64 @@ vast_paths = {'palmer': '/vast/palmer/',
               'weston': '/nfs/weston/'
              }
 
+cluster_filesystems = {'grace': ['gibbs', 'palmer'],
+                       'mccleary': ['gibbs', 'palmer'],
+                       'milgram': ['milgram'],
+                       'misha': ['radev'],
+                       }
+
 common_filespaces = {'grace': ['home.grace', 'project', 'scratch'],
                      'mccleary': ['home.mccleary', 'project', 'scratch'],
                      'milgram': ['home', 'project', 'scratch60'],
                      'misha': ['home','project','scratch'],
                      }
 
+# fraction of a byte or file limit left before a fileset is considered at its limit
+limit_threshold = 0.05
+
+# --watch settings: how often snapshots are stat'ed when inotify can't see a change
+# (e.g. written from another node) and the minimum time between live mmlsquota queries
+watch_poll_interval = 60
+watch_live_interval = 300
+
+# --drilldown: directories that are scanned per cluster (formatted with group, user)
+drilldown_paths = {'grace': ['/gpfs/gibbs/project/{0}/{1}', '/vast/palmer/scratch/{0}/{1}'],
+                   'mccleary': ['/gpfs/gibbs/project/{0}/{1}', '/vast/palmer/scratch/{0}/{1}'],
+                   'milgram': ['/gpfs/milgram/project/{0}/{1}', '/gpfs/milgram/scratch60/{0}/{1}'],
+                   'misha': ['/gpfs/radev/project/{0}/{1}', '/gpfs/radev/scratch/{0}/{1}'],
+                   }
+drilldown_threads = 8
+drilldown_deadline = 120
+
+# node-wide cache of group and pi fileset mmlsquota results, shared by all members of a group
+shared_cache_dir = '/tmp/.getquota'
+shared_cache_ttl = 300
+# failed or timed out queries are remembered briefly, so waiting callers don't retry them one by one
+shared_cache_failure_ttl = 60
+# longest wait for another caller's query before querying without the lock
+shared_cache_lock_timeout = 10
+
+# token buckets for live mmlsquota queries from non-interactive callers (e.g. job arrays), one per user
+# on each node: device: (queries refilled per second, bucket size); an empty bucket means snapshot data
+live_query_rates = {'gibbs': (0.5, 20),
+                    'milgram': (0.5, 20),
+                    'ycga': (0.5, 20),
+                    'radev': (0.5, 20),
+                    }
+live_query_default_rate = (0.5, 20)
+
+# archived snapshot generations, e.g. .mmrepquota/current.2024-06-01.gz for --snapshot-date 2024-06-01
+archived_snapshot_format = '{0}.{1}'
+snapshot_extensions = ['', '.gz', '.zst']
+
+# parsed snapshots and ldap lookups, reused between calls by long-running library users;
+# only the most recently used snapshots are kept, older generations are dropped
+snapshot_cache = {}
+snapshot_cache_size = 16
+group_members_cache = {}
+
 def get_args():
 
-    global debug
-    global active_users_only
     is_me = False
 
     parser = argparse.ArgumentParser(
@@ -52,41 +125,47 @@ def get_args():
     parser.add_argument('-g', '--group', help='usage and quotas for specific group')
     parser.add_argument('-c', '--cluster', default=get_cluster(),
                         help='usage and quotas on alternate cluster')
+    parser.add_argument('-t', '--top', type=int,
+                        help='only list the N largest users in each fileset of the usage details')
+    parser.add_argument('-s', '--sort', choices=['name', 'usage', 'files'],
+                        help='order of the usage details (default: name, or usage with --top)')
+    parser.add_argument('-D', '--drilldown', action='store_true',
+                        help='list the directories using the most space and files in your project and scratch')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='how many directory levels --drilldown reports (default: %(default)s)')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='keep running and update the report when new usage data is available')
+    parser.add_argument('--snapshot-date',
+                        help='report from the archived snapshots of this date (YYYY-MM-DD)')
 
     args = parser.parse_args()
 
-    debug = args.debug
-    active_users_only = args.active_users
-    group = {}
+    if args.top is not None and args.top < 1:
+        parser.error('--top must be at least 1')
 
-    if args.group is None:
-        if args.user is None:
-            # get current user
-            user = getpass.getuser()
-            is_me = True
-        else:
-            user = args.user
-
-        # make sure user is valid, and if so get gid
+    if args.snapshot_date is not None:
         try:
-            group['id'] = pwd.getpwnam(user).pw_gid
-        except:
-            sys.exit('Unknown user: '+user)
+            datetime.strptime(args.snapshot_date, '%Y-%m-%d')
+        except ValueError:
+            parser.error('--snapshot-date must be YYYY-MM-DD')
+        if args.watch:
+            parser.error('--snapshot-date can not be combined with --watch')
 
-    else:
-        # make sure group is valid, and if so get gid
-        try:
-            group['id'] = grp.getgrnam(args.group).gr_gid
-        except:
-            sys.exit('Unknown group: '+args.group)
+    if args.group is None and args.user is None:
+        is_me = True
 
-        # if group is set, no user is set
-        user = None
+    try:
+        user, group = lookup_entity(args.user, args.group)
+    except KeyError:
+        if args.group is None:
+            sys.exit('Unknown user: '+(args.user or getpass.getuser()))
+        else:
+            sys.exit('Unknown group: '+args.group)
 
     ## REMOVE ME
     print_format='cli'
 
-    return user, group, args.cluster, is_me, print_format
+    return user, group, args.cluster, is_me, print_format, args
 
 
 def get_cluster():
@@ -97,9 +176,39 @@ def get_cluster():
     return cluster
 
 
-def get_group_members(group, cluster):
+def get_filesystems(cluster):
+
+    filesystems = list(cluster_filesystems[cluster])
+
+    # check if user in ycga group
+    if cluster in ['mccleary'] and 10266 in os.getgroups():
+        filesystems.append('ycga')
+
+    return filesystems
+
+
+def lookup_entity(user=None, group=None):
+
+    # with no group, the current user if none is given; raises KeyError for unknown names
+    if group is None:
+        if user is None:
+            user = getpass.getuser()
+        gid = pwd.getpwnam(user).pw_gid
+
+    else:
+        gid = grp.getgrnam(group).gr_gid
+        # if group is set, no user is set
+        user = None
+
+    return user, {'id': gid, 'name': grp.getgrgid(gid).gr_name}
 
-    global active_users_only
+
+def get_group_members(group, cluster, active_users_only=False):
+
+    key = (group['id'], cluster, active_users_only)
+    if key in group_members_cache and time.time() - group_members_cache[key][0] <= shared_cache_ttl:
+        group['members'] = list(group_members_cache[key][1])
+        return
 
     with open('/etc/yalehpc', 'r') as f:
         f.readline()
@@ -122,6 +231,8 @@ def get_group_members(group, cluster):
     if group['members'][-1] == '':
         group['members'].pop(-1)
 
+    group_members_cache[key] = (time.time(), list(group['members']))
+
 ### ADAM'S CACHING ###
 
 # try to end something cleanly, ..for whatever reason
@@ -148,7 +259,8 @@ def nonblocking_read(output):
     except:
         return b''
 
-# run something, but discard any errors it may generate and give it a 4-second deadline to complete
+# run something, but discard any errors it may generate and give it a 4-second deadline to complete;
+# returns the output and the return code, which is negative if it had to be killed
 def external_program_filter(cmd):
     timeout = 4
     result = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -159,7 +271,9 @@ def external_program_filter(cmd):
         time.sleep(0.5)
         command_output += str(nonblocking_read(result.stdout).decode("utf-8"))
     timer.cancel()
-    return (command_output)
+    # whatever was written after the last read, e.g. by a command that finished before the first one
+    command_output += str(nonblocking_read(result.stdout).decode("utf-8"))
+    return (command_output, result.returncode)
 
 
 def localcache_quota_data(user):
@@ -173,18 +287,320 @@ def localcache_quota_data(user):
 
     return output
 
+
+def write_localcache_quota_data(user, output):
+
+    # only for ourselves: never write into /tmp on behalf of another user (e.g. from a root prolog).
+    # a new file created with O_EXCL is renamed over the old one, so a planted symlink is never followed
+    if user != getpass.getuser():
+        return
+
+    try:
+        fd, tmp_filename = tempfile.mkstemp(prefix='.'+user+'gqlc.', dir='/tmp')
+    except OSError:
+        return
+
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            pickle.dump(output, file)
+        os.replace(tmp_filename, '/tmp/.'+user+'gqlc')
+    except OSError:
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            pass
+
 ### END ADAM'S CACHING ###
 
+### SHARED GROUP CACHE ###
+
+def run_mmlsquota(query, debug=False):
+
+    # returns the output and whether mmlsquota finished normally, only then is it complete
+    if debug:
+        return subprocess.check_output([query], shell=True, encoding='UTF-8'), True
+    else:
+        output, returncode = external_program_filter(query)
+        return output, returncode == 0
+
+
+class LiveQueryUnavailable(Exception):
+    pass
+
+
+def shared_cache_directory():
+
+    # only use the shared directory if it is a real sticky, world-writable directory owned by root or
+    # ourselves; anyone else owning it could replace the entries in it
+    try:
+        os.makedirs(shared_cache_dir, exist_ok=True)
+        info = os.lstat(shared_cache_dir)
+        if info.st_uid == os.getuid() and stat.S_IMODE(info.st_mode) != 0o1777:
+            os.chmod(shared_cache_dir, 0o1777)
+            info = os.lstat(shared_cache_dir)
+    except OSError:
+        return None
+
+    if (not stat.S_ISDIR(info.st_mode) or stat.S_IMODE(info.st_mode) != 0o1777 or
+            info.st_uid not in [0, os.getuid()]):
+        return None
+
+    return shared_cache_dir
+
+
+def trusted_cache_owner(uid, group):
+
+    # results are shared within a group: trust root, ourselves and members of the group
+    if uid in [0, os.getuid()]:
+        return True
+
+    try:
+        owner = pwd.getpwuid(uid)
+    except KeyError:
+        return False
+
+    return owner.pw_gid == group['id'] or owner.pw_name in group.get('members', [])
+
+
+def read_shared_cache(directory, prefix, group):
+
+    # each user writes <prefix><uid>; returns the newest trusted, fresh result,
+    # '' for a recent failure, or None if there is nothing to use
+    newest = None
+    for name in os.listdir(directory):
+        if not name.startswith(prefix) or not name[len(prefix):].isdigit():
+            continue
+
+        try:
+            info = os.lstat(directory+'/'+name)
+        except OSError:
+            continue
+
+        if (not stat.S_ISREG(info.st_mode) or info.st_uid != int(name[len(prefix):]) or
+                not trusted_cache_owner(info.st_uid, group)):
+            continue
+
+        if newest is None or info.st_mtime > newest[0]:
+            newest = (info.st_mtime, name, info.st_size)
+
+    if newest is None:
+        return None
+
+    mtime, name, size = newest
+    ttl = shared_cache_ttl if size > 0 else shared_cache_failure_ttl
+    if time.time() - mtime > ttl:
+        return None
+
+    try:
+        with open(directory+'/'+name, 'r') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def write_shared_cache(directory, prefix, result):
+
+    # write a new file and rename it over our own entry, so readers never see a partial result
+    filename = '{0}/{1}{2}'.format(directory, prefix, os.getuid())
+    tmp_filename = '{0}/.{1}{2}.{3}'.format(directory, prefix, os.getuid(), os.getpid())
+
+    try:
+        fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        with os.fdopen(fd, 'w') as f:
+            f.write(result)
+        os.replace(tmp_filename, filename)
+    except OSError:
+        try:
+            os.unlink(tmp_filename)
+        except OSError:
+            pass
+
+
+def lock_shared_cache(directory, prefix):
+
+    # returns a locked fd, or None if the lock can't be had in time; never follows a symlink or
+    # blocks opening a fifo someone put in place of the lock file
+    try:
+        fd = os.open(directory+'/'+prefix+'lock', os.O_RDONLY | os.O_CREAT | os.O_NOFOLLOW | os.O_NONBLOCK, 0o644)
+    except OSError:
+        return None
+
+    try:
+        is_file = stat.S_ISREG(os.fstat(fd).st_mode)
+    except OSError:
+        is_file = False
+    if not is_file:
+        os.close(fd)
+        return None
+
+    deadline = time.time() + shared_cache_lock_timeout
+    while True:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except BlockingIOError:
+            if time.time() > deadline:
+                os.close(fd)
+                return None
+            time.sleep(0.1)
+        except OSError:
+            os.close(fd)
+            return None
+
+
+def shared_mmlsquota(query, device, entity, group, debug=False, rate_limit=False):
+
+    # single-flight: the first caller holds the lock while it queries gpfs, everyone
+    # else waiting on the lock then reads its result until it is older than the ttl
+    directory = shared_cache_directory()
+    if directory is None:
+        return limited_mmlsquota(query, device, debug, rate_limit)[0]
+
+    prefix = '{0}.{1}.'.format(device, entity)
+    lock_fd = lock_shared_cache(directory, prefix)
+
+    try:
+        result = read_shared_cache(directory, prefix, group)
+        if result == '':
+            raise LiveQueryUnavailable('recent mmlsquota query failed: '+query)
+        elif result is not None and validate_gpfs_returned_values(result, debug) is not None:
+            return result
+
+        # failures are cached as an empty result, which waiting callers treat as "use the snapshot"
+        try:
+            result, complete = limited_mmlsquota(query, device, debug, rate_limit)
+        except LiveQueryUnavailable:
+            # out of tokens isn't a failed query, the next caller may still have some
+            raise
+        except Exception:
+            write_shared_cache(directory, prefix, '')
+            raise
+
+        # a killed or failed query may have returned only part of its output, never share that
+        if complete and validate_gpfs_returned_values(result, debug) is not None:
+            write_shared_cache(directory, prefix, result)
+        else:
+            write_shared_cache(directory, prefix, '')
+    finally:
+        if lock_fd is not None:
+            os.close(lock_fd)
+
+    return result
+
+### END SHARED GROUP CACHE ###
+
+### LIVE QUERY RATE LIMIT ###
+
+def is_interactive():
+    # daemons and other long-running callers may have no stdin at all
+    return sys.stdin is not None and sys.stdin.isatty()
+
+
+def take_live_query_token(device):
+
+    # token bucket kept as "<tokens> <last refill>" in a locked file only this user can write;
+    # anything unexpected means no token, so the caller uses the snapshot
+    rate, burst = live_query_rates.get(device, live_query_default_rate)
+
+    directory = shared_cache_directory()
+    if directory is None:
+        return False
+
+    filename = '{0}/{1}.{2}.bucket'.format(directory, device, os.getuid())
+    try:
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+    except OSError:
+        return False
+
+    with os.fdopen(fd, 'r+') as f:
+        info = os.fstat(fd)
+        if info.st_uid != os.getuid() or not stat.S_ISREG(info.st_mode):
+            return False
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+        now = time.time()
+        try:
+            tokens, last_refill = [float(value) for value in f.read().split()]
+        except ValueError:
+            tokens, last_refill = burst, now
+        tokens = max(0, min(burst, tokens + (now - last_refill)*rate))
+
+        available = tokens >= 1
+        if available:
+            tokens -= 1
+
+        f.seek(0)
+        f.truncate()
+        f.write('{0} {1}'.format(tokens, now))
+
+    return available
+
+
+def limited_mmlsquota(query, device, debug=False, rate_limit=False):
+
+    # only spend a token when gpfs is really about to be queried; returns run_mmlsquota's result
+    if rate_limit and not take_live_query_token(device):
+        raise LiveQueryUnavailable('live query limit reached on '+device)
+
+    return run_mmlsquota(query, debug)
+
+### END LIVE QUERY RATE LIMIT ###
+
 
 ## PI FILESET CHECKS
 
-def add_missing_pi_filesets(user_filesets, group):
-#### BROKEN BUT MAYBE WE DONT
-    # fix for forcing pi filesets to show up for all primary group members
-    for fileset in sum(filesets_by_filesystems.values(), []):
-        #if group in fileset and fileset not in user_filesets:
-        if re.search(rf"[^:]+?:pi_{group['name']}$", fileset) and fileset not in user_filesets:
-            user_filesets.append(fileset)
+# lab filesets not named pi_<group>: fileset -> owning group, e.g. 'gibbs:somelab': 'somelab_group'
+dedicated_pi_filesets = {}
+
+# filesets that are neither shared spaces nor a lab's
+other_filesets = ['root', 'globus']
+
+def classify_fileset(fileset):
+
+    # 'pi', 'home', 'project', 'scratch', 'work', 'apps' or 'other'
+    name = fileset.split(':')[-1]
+    if name.startswith('pi_') or fileset in dedicated_pi_filesets:
+        return 'pi'
+    for fileset_type in ['home', 'project', 'scratch', 'work', 'apps']:
+        if name.startswith(fileset_type):
+            return fileset_type
+    if name in other_filesets:
+        return 'other'
+
+    # anything else is a lab fileset, even when it isn't named after its group
+    return 'pi'
+
+
+def index_pi_filesets(filesets):
+
+    # group -> its pi filesets in one snapshot, built (and cached) with the snapshot as it is read;
+    # ownership only comes from the name or dedicated_pi_filesets, GRP rows just mean a group has data there
+    index = {}
+
+    for fileset in filesets:
+        name = fileset.split(':')[-1]
+        if name.startswith('pi_'):
+            index.setdefault(name[3:], set()).add(fileset)
+        elif fileset in dedicated_pi_filesets:
+            index.setdefault(dedicated_pi_filesets[fileset], set()).add(fileset)
+
+    return index
+
+
+def merge_pi_fileset_index(pi_filesets, index):
+
+    # pi_filesets only lives for one collection, so filesets of other snapshot generations never leak in
+    for group_name, filesets in index.items():
+        pi_filesets.setdefault(group_name, set()).update(filesets)
+
+
+def add_missing_pi_filesets(user_filesets, group, user_based_usage, filesystems, pi_filesets):
+
+    # make pi filesets show up for all primary group members, even without data in them
+    for fileset in pi_filesets.get(group['name'], []):
+        if fileset.split(':')[0] in filesystems and fileset not in user_filesets:
+            user_filesets.add(fileset)
+            user_based_usage.setdefault(fileset, {})
 
 
 def is_pi_fileset(fileset, section=None):
@@ -192,17 +608,19 @@ def is_pi_fileset(fileset, section=None):
     if section is not None and 'FILESET' not in section:
         return False
 
-    if 'pi' in fileset:
-        return True
-    elif 'scratch' in fileset or 'home' in fileset or 'project' in fileset or 'work' in fileset:
-        return False
-    elif 'apps' in fileset:
-        return False
-    else:
-        return True
+    return classify_fileset(fileset) == 'pi'
 
 ### HELPER FUNCTIONS
 
+def warn(message, warnings=None):
+
+    # library callers collect messages in a list instead of having them printed
+    if warnings is None:
+        print(message)
+    else:
+        warnings.append(message)
+
+
 def place_output(output, quota):
     if 'home' in quota['fileset']:
         output[0] = quota
@@ -242,6 +660,7 @@ def parse_gpfs_mmrepquota_line(line, filesystem):
     # filesUsage+filesInDoubt, filesQuota
 
     quota = {'fileset': fileset,
+            'type': quota_type,
             'name': name, # netid is quota_type = USR, groupname if quota_type = GRP, '' if FILESET
             'used_gib': int(split[10])/1024/1024+int(split[13])/1024/1024, # blockUsage+blockInDoubt
             'quota_gib': int(split[12])/1024/1024, # blockQuota
@@ -252,35 +671,233 @@ def parse_gpfs_mmrepquota_line(line, filesystem):
     return quota
 
 
-def read_mmrepquota_gpfs(filesystem, this_user, cluster, group, usage_details, user_filesets):
+### SNAPSHOT FILES
+
+def snapshot_path(filename, snapshot_date=None):
+
+    # the current snapshot, or the generation archived on snapshot_date, either possibly compressed
+    if snapshot_date is not None:
+        filename = archived_snapshot_format.format(filename, snapshot_date)
 
-    filename = '/gpfs/'+filesystem + '/.mmrepquota/current'
+    for extension in snapshot_extensions:
+        if os.path.exists(filename+extension):
+            return filename+extension
 
-    if not os.path.exists(filename):
-        print("%s is not available at the moment" % filesystem)
-    else:    
-        with open(filename, 'r') as f:
-            f.readline()
-            for line in f:
+    return None
 
-                if 'USR' not in line or 'root' in line or 'apps' in line:
-                    continue
 
-                user_data = parse_gpfs_mmrepquota_line(line, filesystem)
-                
-                if user_data['fileset'] == 'milgram:globus':
-                    continue
+class SnapshotReader:
 
-                if user_data['fileset'] not in usage_details.keys():
-                    usage_details[user_data['fileset']] = {}
+    # text stream over a gzip or zstd compressed snapshot: a background thread decompresses
+    # chunks into a short queue, so neither the compressed nor the full text is held in memory
+    chunk_size = 1024*1024
+
+    def __init__(self, filename):
+        self.chunks = queue.Queue(maxsize=8)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.closed = False
+        self.lines = self.read_lines()
+        # text not yet returned by read(size)
+        self.texts = self.read_chunks()
+        self.pending = ''
+
+        self.thread = threading.Thread(target=self.decompress, args=(filename,), daemon=True)
+        self.thread.start()
+
+    def decompress(self, filename):
+        try:
+            if filename.endswith('.gz'):
+                with gzip.open(filename, 'rb') as f:
+                    self.put_chunks(f)
+            elif zstandard is not None:
+                with open(filename, 'rb') as f:
+                    self.put_chunks(zstandard.ZstdDecompressor().stream_reader(f))
+            else:
+                result = subprocess.Popen(['zstd', '-dcq', filename], stdout=subprocess.PIPE,
+                                          stderr=subprocess.DEVNULL)
+                self.put_chunks(result.stdout)
+                result.stdout.close()
+                # only a reader that stopped early may cut zstd short, otherwise a truncated
+                # or corrupt file must not pass as a complete snapshot
+                if self.closed:
+                    result.kill()
+                    result.wait()
+                elif result.wait() != 0:
+                    raise OSError('zstd failed to decompress '+filename)
+        except Exception as e:
+            # hand the error to the reading thread
+            self.put(e)
+        self.put(None)
+
+    def put_chunks(self, f):
+        while not self.closed:
+            chunk = f.read(self.chunk_size)
+            if not chunk:
+                break
+            self.put(chunk)
+
+    def put(self, chunk):
+        while not self.closed:
+            try:
+                self.chunks.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def read_chunks(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                yield self.decoder.decode(b'', final=True)
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield self.decoder.decode(chunk)
+
+    def read_lines(self):
+        partial = ''
+        for text in self.read_chunks():
+            lines = (partial+text).split('\n')
+            partial = lines.pop()
+            for line in lines:
+                yield line+'\n'
+        if partial:
+            yield partial
+
+    def __iter__(self):
+        return self.lines
+
+    def readline(self):
+        return next(self.lines, '')
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return ''.join(self.lines)
+
+        # up to size characters at a time, for parsers that don't work on lines; not to be mixed with readline
+        while len(self.pending) < size:
+            text = next(self.texts, None)
+            if text is None:
+                break
+            self.pending += text
+        text, self.pending = self.pending[:size], self.pending[size:]
+        return text
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_snapshot(filename):
+
+    if filename.endswith('.gz') or filename.endswith('.zst'):
+        return SnapshotReader(filename)
+    else:
+        return open(filename, 'r')
 
-                usage_details[user_data['fileset']][user_data['name']] = user_data
 
-                if user_data['name'] == this_user or (this_user is None and user_data['name'] in group['members']):
-                    user_filesets.add(user_data['fileset'])
+def cached_snapshot(filename, parser, *parser_args):
 
+    # parse each snapshot once per update, so repeated library calls don't re-read it
+    key = (filename, parser.__name__)
+    mtime = os.path.getmtime(filename)
+    cached = snapshot_cache.pop(key, None)
+    if cached is None or cached[0] != mtime:
+        result = parser(filename, *parser_args)
+        # parsers return None when there is nothing usable (yet), try again next time
+        if result is None:
+            return None
+        cached = (mtime, result)
 
-def validate_gpfs_returned_values(result):
+    # re-inserted last, so the first key is always the least recently used
+    snapshot_cache[key] = cached
+    while len(snapshot_cache) > snapshot_cache_size:
+        del snapshot_cache[next(iter(snapshot_cache))]
+
+    return cached[1]
+
+
+def gpfs_quota_records(filename, filesystem):
+
+    with open_snapshot(filename) as f:
+        f.readline()
+        for line in f:
+            if 'HEADER' in line or len(line) < 10:
+                continue
+            yield parse_gpfs_mmrepquota_line(line, filesystem)
+
+
+def parse_gpfs_snapshot(filename, filesystem):
+
+    # usage: USR rows per fileset for the usage details
+    # quotas: the rows sort_gpfs_quota can place in the quota summary
+    # pi_index: pi filesets per group
+    snapshot = {'usage': {}, 'quotas': []}
+    filesets = set()
+
+    with open_snapshot(filename) as f:
+        f.readline()
+        for line in f:
+            if 'HEADER' in line or len(line) < 10:
+                continue
+
+            user_data = parse_gpfs_mmrepquota_line(line, filesystem)
+
+            filesets.add(user_data['fileset'])
+
+            if is_summary_line(line):
+                snapshot['quotas'].append(user_data)
+
+            if 'USR' not in line or 'root' in line or 'apps' in line:
+                continue
+
+            if user_data['fileset'] == 'milgram:globus':
+                continue
+
+            if user_data['fileset'] not in snapshot['usage'].keys():
+                snapshot['usage'][user_data['fileset']] = {}
+
+            snapshot['usage'][user_data['fileset']][user_data['name']] = user_data
+
+    snapshot['pi_index'] = index_pi_filesets(filesets)
+
+    return snapshot
+
+
+def read_mmrepquota_gpfs(filesystem, this_user, cluster, group, usage_details, user_filesets, pi_filesets,
+                         snapshot_date=None, warnings=None):
+
+    filename = snapshot_path('/gpfs/'+filesystem + '/.mmrepquota/current', snapshot_date)
+
+    if filename is None:
+        warn("%s is not available at the moment" % filesystem, warnings)
+        return
+
+    columns = None
+    if numpy is not None:
+        columns = cached_snapshot(filename, load_columnar_snapshot)
+
+    if columns is not None:
+        merge_pi_fileset_index(pi_filesets, columns['pi_index'])
+        read_columnar_usage(columns, this_user, group, usage_details, user_filesets)
+    else:
+        snapshot = cached_snapshot(filename, parse_gpfs_snapshot, filesystem)
+        merge_pi_fileset_index(pi_filesets, snapshot['pi_index'])
+
+        for fileset, fileset_usage in snapshot['usage'].items():
+            usage_details[fileset] = fileset_usage
+
+            if this_user in fileset_usage or (this_user is None and
+                                              any(member in fileset_usage for member in group['members'])):
+                user_filesets.add(fileset)
+
+
+def validate_gpfs_returned_values(result, debug=False):
     if not re.match("^mmlsq", result):
         if debug:
             print("Invalid results returned:", result)
@@ -289,27 +906,21 @@ def validate_gpfs_returned_values(result):
         return result
 
 
-def quota_data_gpfs(filesets, filesystem, user, group, cluster, output, is_live=True):
+def quota_data_gpfs(filesets, filesystem, user, group, cluster, output, is_live=True, debug=False,
+                    snapshot_date=None, rate_limit=False):
 
-    global debug
     quota_script = '/usr/lpp/mmfs/bin/mmlsquota'
 
     if is_live:
         # get group level usage
         device = gpfs_device_names[filesystem]
         query = '{0} -g {1} -Y --block-size auto {2}'.format(quota_script, group['name'], device)
-        if debug:
-            result = subprocess.check_output([query], shell=True, encoding='UTF-8')
-        else:
-            result = external_program_filter(query)
+        result = shared_mmlsquota(query, device, 'group.'+group['name'], group, debug, rate_limit)
 
-        # user based home quotas
-        if device not in ['gibbs', 'ycga']:
+        # user based home quotas, library callers may only ask for a group
+        if user is not None and device not in ['gibbs', 'ycga']:
             query = '{0} -u {1} -Y --block-size auto {2} '.format(quota_script, user, device)
-            if debug:
-                result += subprocess.check_output([query], shell=True, encoding='UTF-8')
-            else:
-                result += external_program_filter(query)
+            result += limited_mmlsquota(query, device, debug, rate_limit)[0]
 
         # now add pi filesets previously identified in read_mmrepquota_gpfs
         for fileset in filesets:
@@ -317,42 +928,50 @@ def quota_data_gpfs(filesets, filesystem, user, group, cluster, output, is_live=
                 fileset_name = fileset.split(':')[1]
 
                 query = '{0} -j {1} -Y {2}'.format(quota_script, fileset_name, device)
-                if debug:
-                    result += subprocess.check_output([query], shell=True, encoding='UTF-8')
-                else:
-                    result += external_program_filter(query)
+                result += shared_mmlsquota(query, device, 'fileset.'+fileset_name, group, debug, rate_limit)
 
         # make sure that result holds valid data
-        result = validate_gpfs_returned_values(result).split('\n')
+        result = validate_gpfs_returned_values(result, debug).split('\n')
 
         for line in result:
-            sort_gpfs_quota(line, filesystem, filesets, user, group, output)
+            if is_summary_line(line):
+                sort_gpfs_quota(parse_gpfs_mmrepquota_line(line, filesystem), filesets, user, group, output)
 
     #read from flat file instead of gpfs query
     else:
 
-        filename = '/gpfs/'+filesystem + '/.mmrepquota/current'
+        filename = snapshot_path('/gpfs/'+filesystem + '/.mmrepquota/current', snapshot_date)
 
-        if not os.path.exists(filename):
+        if filename is None:
              return output
 
-        with open(filename, 'r') as f:
-            for line in f:
-                sort_gpfs_quota(line, filesystem, filesets, user, group, output)
+        columns = None
+        if numpy is not None:
+            columns = cached_snapshot(filename, load_columnar_snapshot)
+
+        if columns is not None:
+            quotas = columnar_summary_quotas(columns, filesets)
+        else:
+            quotas = cached_snapshot(filename, parse_gpfs_snapshot, filesystem)['quotas']
+
+        for quota in quotas:
+            sort_gpfs_quota(quota, filesets, user, group, output)
 
     return output
 
-def sort_gpfs_quota(line, filesystem, filesets, user, group, output):
+def is_summary_line(line):
 
     # filter for just relevant rows
     if 'HEADER' in line or 'root' in line or 'apps' in line or len(line) < 10:
-        return
+        return False
     if ('USR' in line and 'home' not in line):
-        return
+        return False
     if ('GRP' in line and ('scratch' not in line and 'project' not in line and 'work' not in line)):
-        return
+        return False
+
+    return True
 
-    quota = parse_gpfs_mmrepquota_line(line, filesystem)
+def sort_gpfs_quota(quota, filesets, user, group, output):
 
     if quota['fileset'] in filesets:
         if (('home' in quota['fileset'] and quota['name'] == user) or quota['name'] == group['name']):
@@ -363,7 +982,65 @@ def sort_gpfs_quota(line, filesystem, filesets, user, group, output):
 
 ### VAST
 
-def quota_data_vast(filesystem, user, group, cluster, output, is_live=False):
+def json_array_records(f):
+
+    # decodes a json array one element at a time, so only the current chunk of text is held
+    # in memory instead of the whole (decompressed) file
+    decoder = json.JSONDecoder()
+    buffer = ''
+    while not buffer:
+        text = f.read(SnapshotReader.chunk_size)
+        if text == '':
+            break
+        buffer = text.lstrip()
+    if not buffer.startswith('['):
+        raise ValueError('not a json array')
+
+    position = 1
+    eof = False
+    while True:
+        # skip whitespace and the separator before the next element
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer) or eof:
+                break
+            buffer, position = f.read(SnapshotReader.chunk_size), 0
+            eof = buffer == ''
+
+        if position >= len(buffer):
+            raise ValueError('unterminated json array')
+        if buffer[position] == ']':
+            return
+
+        try:
+            record, end = decoder.raw_decode(buffer, position)
+        except ValueError:
+            # the element continues in the next chunk, or the file is truncated
+            if eof:
+                raise
+            text = f.read(SnapshotReader.chunk_size)
+            eof = text == ''
+            buffer, position = buffer[position:] + text, 0
+            continue
+
+        # a number at the end of the buffer may have been cut off, decode it again with more text
+        if end == len(buffer) and not eof:
+            text = f.read(SnapshotReader.chunk_size)
+            eof = text == ''
+            buffer, position = buffer[position:] + text, 0
+            continue
+
+        yield record
+        position = end
+
+
+def load_json_snapshot(filename):
+    with open_snapshot(filename) as f:
+        return list(json_array_records(f))
+
+
+def quota_data_vast(filesystem, user, group, cluster, output, is_live=False, snapshot_date=None):
 
     filenames = [vast_paths[filesystem] + '/.quotas/current']
     if cluster == 'mccleary':
@@ -377,60 +1054,99 @@ def quota_data_vast(filesystem, user, group, cluster, output, is_live=False):
         uid = ""
 
     for filename in filenames:
-        if not os.path.exists(filename):
+        filename = snapshot_path(filename, snapshot_date)
+        if filename is None:
             return output
         
-        with open(filename, 'r') as f:
-            vast_quota_data = json.load(f)
-
-            for this_quota in vast_quota_data:
-
-                if 'mccleary' in filename or 'grace' in filename:
-
-                    if user is not None and (user == this_quota['entity_identifier'] or uid == this_quota['entity_identifier']):
-                        fileset = 'palmer:home.'+cluster
-                        ### FIX: REPLACE used_effective_capacity instead of used_capacity
-                        quota = {'fileset': fileset,
-                                'name': this_quota['entity_identifier'],
-                                'used_gib': this_quota['used_capacity']/1024/1024/1024,
-                                'quota_gib': this_quota['hard_limit']/1024/1024/1024,
-                                'used_files': this_quota['used_inodes'],
-                                'quota_files': this_quota['hard_limit_inodes']
-                                }
-
-                    #    [fileset, quota['entity_identifier'], 'USR', quota['used_capacity']/1024/1024/1024,
-                    #                        quota['hard_limit']/1024/1024/1024, quota['used_inodes'], quota['hard_limit_inodes']]
-                        place_output(output, quota)
-                else:
-                    if ':' in this_quota['name']:
-
-                        fileset, name = this_quota['name'].split(':')
-                        if group['name'] == name:
-                            if 'scratch' in fileset:
-                                fileset = filesystem+':'+fileset
-                                quota = {'fileset': fileset,
-                                        'name': group['name'],
-                                        'used_gib': this_quota['used_effective_capacity']/1024/1024/1024,
-                                        'quota_gib': this_quota['hard_limit']/1024/1024/1024,
-                                        'used_files': this_quota['used_inodes'],
-                                        'quota_files': this_quota['hard_limit_inodes']
-                                        }
-                             #   data = [fileset, group['name'], 'GRP', quota['used_effective_capacity']/1024/1024/1024,
-                                   #     quota['hard_limit']/1024/1024/1024, quota['used_inodes'], quota['hard_limit_inodes']]
-                                place_output(output, quota)
-                            elif fileset == 'pi':
-                                quota = {'fileset': 'palmer:pi_'+group['name'],
-                                        'name': group['name'],
-                                        'used_gib': this_quota['used_effective_capacity']/1024/1024/1024,
-                                        'quota_gib': this_quota['hard_limit']/1024/1024/1024,
-                                        'used_files': this_quota['used_inodes'],
-                                        'quota_files': this_quota['hard_limit_inodes']
-                                        }
-                               # data = ['palmer:pi_'+group['name'], group['name'], 'FILESET', quota['used_effective_capacity']/1024/1024/1024,
-                               #         quota['hard_limit']/1024/1024/1024, quota['used_inodes'], quota['hard_limit_inodes']]
-                                output.append(quota)
+        vast_quota_data = cached_snapshot(filename, load_json_snapshot)
+
+        for this_quota in vast_quota_data:
+
+            if 'mccleary' in filename or 'grace' in filename:
+
+                if user is not None and (user == this_quota['entity_identifier'] or uid == this_quota['entity_identifier']):
+                    fileset = 'palmer:home.'+cluster
+                    ### FIX: REPLACE used_effective_capacity instead of used_capacity
+                    quota = {'fileset': fileset,
+                            'type': 'USR',
+                            'name': this_quota['entity_identifier'],
+                            'used_gib': this_quota['used_capacity']/1024/1024/1024,
+                            'quota_gib': this_quota['hard_limit']/1024/1024/1024,
+                            'used_files': this_quota['used_inodes'],
+                            'quota_files': this_quota['hard_limit_inodes']
+                            }
+
+                #    [fileset, quota['entity_identifier'], 'USR', quota['used_capacity']/1024/1024/1024,
+                #                        quota['hard_limit']/1024/1024/1024, quota['used_inodes'], quota['hard_limit_inodes']]
+                    place_output(output, quota)
+            else:
+                if ':' in this_quota['name']:
+
+                    fileset, name = this_quota['name'].split(':')
+                    if group['name'] == name:
+                        if 'scratch' in fileset:
+                            fileset = filesystem+':'+fileset
+                            quota = {'fileset': fileset,
+                                    'type': 'GRP',
+                                    'name': group['name'],
+                                    'used_gib': this_quota['used_effective_capacity']/1024/1024/1024,
+                                    'quota_gib': this_quota['hard_limit']/1024/1024/1024,
+                                    'used_files': this_quota['used_inodes'],
+                                    'quota_files': this_quota['hard_limit_inodes']
+                                    }
+                         #   data = [fileset, group['name'], 'GRP', quota['used_effective_capacity']/1024/1024/1024,
+                               #     quota['hard_limit']/1024/1024/1024, quota['used_inodes'], quota['hard_limit_inodes']]
+                            place_output(output, quota)
+                        elif fileset == 'pi':
+                            quota = {'fileset': 'palmer:pi_'+group['name'],
+                                    'type': 'FILESET',
+                                    'name': group['name'],
+                                    'used_gib': this_quota['used_effective_capacity']/1024/1024/1024,
+                                    'quota_gib': this_quota['hard_limit']/1024/1024/1024,
+                                    'used_files': this_quota['used_inodes'],
+                                    'quota_files': this_quota['hard_limit_inodes']
+                                    }
+                           # data = ['palmer:pi_'+group['name'], group['name'], 'FILESET', quota['used_effective_capacity']/1024/1024/1024,
+                           #         quota['hard_limit']/1024/1024/1024, quota['used_inodes'], quota['hard_limit_inodes']]
+                            output.append(quota)
     return output
 
+def vast_quota_records(filename, filesystem):
+
+    # every quota in a vast quota file, in the same form as parse_gpfs_mmrepquota_line
+    basename = os.path.basename(filename).split('.')[0]
+
+    for this_quota in load_json_snapshot(filename):
+
+        # <cluster>_current holds the home quotas
+        if basename != 'current':
+            quota = {'fileset': filesystem+':home.'+basename.split('_')[0],
+                     'type': 'USR',
+                     'name': this_quota['entity_identifier'],
+                     'used_gib': this_quota['used_capacity']/1024/1024/1024,
+                     }
+        elif ':' in this_quota['name']:
+            fileset, name = this_quota['name'].split(':')
+            if fileset == 'pi':
+                quota = {'fileset': filesystem+':pi_'+name,
+                         'type': 'FILESET',
+                         'name': name,
+                         }
+            else:
+                quota = {'fileset': filesystem+':'+fileset,
+                         'type': 'GRP',
+                         'name': name,
+                         }
+            quota['used_gib'] = this_quota['used_effective_capacity']/1024/1024/1024
+        else:
+            continue
+
+        quota['quota_gib'] = this_quota['hard_limit']/1024/1024/1024
+        quota['used_files'] = this_quota['used_inodes']
+        quota['quota_files'] = this_quota['hard_limit_inodes']
+
+        yield quota
+
 # Outputs generated by cron on monitor1.grace that runs starfish_vast_usage.py
 def read_vast_line(line):
     data = {}
@@ -445,87 +1161,266 @@ def read_vast_line(line):
     return data
 
 
-def read_user_details_vast(filesystem, this_user, group, user_based_usage, user_filesets):
+def parse_vast_details(filename):
+
+    with open_snapshot(filename) as f:
+        f.readline()
+        return [read_vast_line(line) for line in f]
+
+
+def parse_vast_pi_index(filename, filesystem):
+
+    pi_quotas = [quota for quota in vast_quota_records(filename, filesystem) if quota['type'] == 'FILESET']
+
+    return index_pi_filesets([quota['fileset'] for quota in pi_quotas])
 
-    read_user_details_vast_scratch(filesystem, group, user_based_usage, user_filesets)
-    read_user_details_vast_pi(filesystem, this_user, group, user_based_usage, user_filesets)
 
+def read_user_details_vast(filesystem, this_user, group, user_based_usage, user_filesets, pi_filesets,
+                           snapshot_date=None):
 
-def read_user_details_vast_scratch(filesystem, group, user_based_usage, user_filesets):
+    filename = snapshot_path(vast_paths[filesystem] + '.quotas/current', snapshot_date)
+    if filename is not None:
+        merge_pi_fileset_index(pi_filesets, cached_snapshot(filename, parse_vast_pi_index, filesystem))
+
+    read_user_details_vast_scratch(filesystem, group, user_based_usage, user_filesets, snapshot_date)
+    read_user_details_vast_pi(filesystem, this_user, group, user_based_usage, user_filesets, snapshot_date)
+
+
+def read_user_details_vast_scratch(filesystem, group, user_based_usage, user_filesets, snapshot_date=None):
 
     # scratch
     fileset = 'palmer:scratch'
     user_based_usage[fileset] = {}
 
-    filename = '/vast/palmer/.quotas/scratch.details'
-    if not os.path.exists(filename):
+    filename = snapshot_path('/vast/palmer/.quotas/scratch.details', snapshot_date)
+    if filename is None:
             return
 
-    with open(filename, 'r') as f:
-        f.readline()
-        for line in f:
-            # group, username, filecount, usage (kb), usage (string)
-            data = read_vast_line(line)
-            if data['group'] != group['name']:
-                continue
-            else:
-                user_based_usage[fileset][data['user']] = {'used_gib':  data['usage_GiB'],
-                                                           'used_files':  data['usage_files'],
-                                                         }
-                user_filesets.add(fileset)
+    # group, username, filecount, usage (kb), usage (string)
+    for data in cached_snapshot(filename, parse_vast_details):
+        if data['group'] != group['name']:
+            continue
+        else:
+            user_based_usage[fileset][data['user']] = {'used_gib':  data['usage_GiB'],
+                                                       'used_files':  data['usage_files'],
+                                                     }
+            user_filesets.add(fileset)
 
 
-def read_user_details_vast_pi(filesystem, this_user, group, user_based_usage, user_filesets):
+def read_user_details_vast_pi(filesystem, this_user, group, user_based_usage, user_filesets, snapshot_date=None):
 
     # pi filesets
-    filename = '/vast/palmer/.quotas/pi.details'
-    if not os.path.exists(filename):
+    filename = snapshot_path('/vast/palmer/.quotas/pi.details', snapshot_date)
+    if filename is None:
             return
 
-    with open(filename, 'r') as f:
-        f.readline()
-        for line in f:
+    for data in cached_snapshot(filename, parse_vast_details):
 
-            data = read_vast_line(line)
-            user = data['user']
-            fileset = 'palmer:pi_'+data['group']
-            if fileset not in user_based_usage.keys():
-                    user_based_usage[fileset] = {}
+        user = data['user']
+        fileset = 'palmer:pi_'+data['group']
+        if fileset not in user_based_usage.keys():
+                user_based_usage[fileset] = {}
 
-            user_based_usage[fileset][data['user']] = {'used_gib':  data['usage_GiB'],
-                                                       'used_files':  data['usage_files'],
-                                                       }
+        user_based_usage[fileset][data['user']] = {'used_gib':  data['usage_GiB'],
+                                                   'used_files':  data['usage_files'],
+                                                   }
 
-            if user == this_user or (this_user is None and user in group['members']):
-                user_filesets.add(fileset)
+        if user == this_user or (this_user is None and user in group['members']):
+            user_filesets.add(fileset)
+
+
+### COLUMNAR SNAPSHOTS
+#
+# convert_snapshots.py turns each text snapshot into <snapshot>.columns/, one .npy file per
+# numeric column plus dictionary.json with the names the type/name/fileset codes refer to.
+# The .npy files are memory mapped, and the columns are only used while the text snapshot
+# they were converted from is unchanged.
+
+columnar_types = ['USR', 'GRP', 'FILESET']
+columnar_fields = ['type', 'name', 'fileset', 'used_gib', 'quota_gib', 'used_files', 'quota_files']
+
+def columns_from_records(records):
+
+    codes = {'type': {quota_type: i for i, quota_type in enumerate(columnar_types)},
+             'name': {},
+             'fileset': {}}
+    data = {field: [] for field in columnar_fields}
+
+    for quota in records:
+        for field in ['name', 'fileset']:
+            data[field].append(codes[field].setdefault(quota[field], len(codes[field])))
+        data['type'].append(codes['type'][quota['type']])
+        for field in ['used_gib', 'quota_gib', 'used_files', 'quota_files']:
+            data[field].append(quota[field])
+
+    columns = {'type': numpy.array(data['type'], dtype=numpy.uint8),
+               'name': numpy.array(data['name'], dtype=numpy.int32),
+               'fileset': numpy.array(data['fileset'], dtype=numpy.int32),
+               'used_gib': numpy.array(data['used_gib'], dtype=numpy.float64),
+               'quota_gib': numpy.array(data['quota_gib'], dtype=numpy.float64),
+               'used_files': numpy.array(data['used_files'], dtype=numpy.int64),
+               'quota_files': numpy.array(data['quota_files'], dtype=numpy.int64),
+               'names': list(codes['name'].keys()),
+               'filesets': list(codes['fileset'].keys()),
+               }
+
+    return add_columnar_indexes(columns)
+
+
+def add_columnar_indexes(columns):
+
+    columns['name_codes'] = {name: i for i, name in enumerate(columns['names'])}
+    columns['fileset_codes'] = {fileset: i for i, fileset in enumerate(columns['filesets'])}
+
+    # the filters read_mmrepquota_gpfs and is_summary_line apply to text lines, per name and fileset
+    skip_name = numpy.array(['root' in name or 'apps' in name for name in columns['names']], dtype=bool)
+    skip_fileset = numpy.array(['root' in fileset or 'apps' in fileset or fileset == 'milgram:globus'
+                                for fileset in columns['filesets']], dtype=bool)
+    home = numpy.array(['home' in fileset for fileset in columns['filesets']], dtype=bool)
+    group_dirs = numpy.array(['scratch' in fileset or 'project' in fileset or 'work' in fileset
+                              for fileset in columns['filesets']], dtype=bool)
+
+    keep = ~skip_name[columns['name']] & ~skip_fileset[columns['fileset']]
+    quota_type = columns['type']
+
+    # same pi fileset index parse_gpfs_snapshot builds
+    columns['pi_index'] = index_pi_filesets(columns['filesets'])
+
+    columns['usage_rows'] = keep & (quota_type == columnar_types.index('USR'))
+    columns['summary_rows'] = keep & ((quota_type == columnar_types.index('FILESET')) |
+                                      ((quota_type == columnar_types.index('USR')) & home[columns['fileset']]) |
+                                      ((quota_type == columnar_types.index('GRP')) & group_dirs[columns['fileset']]))
+
+    return columns
+
+
+def write_columnar_snapshot(filename, records):
+
+    mtime = os.path.getmtime(filename)
+    columns = columns_from_records(records)
+
+    directory = filename + '.columns'
+    tmp_directory = '{0}.{1}'.format(directory, os.getpid())
+    os.makedirs(tmp_directory)
+
+    for field in columnar_fields:
+        numpy.save(tmp_directory+'/'+field+'.npy', columns[field])
+    with open(tmp_directory+'/dictionary.json', 'w') as f:
+        json.dump({'source_mtime': mtime,
+                   'names': columns['names'],
+                   'filesets': columns['filesets']}, f)
+
+    # swap in the new columns, readers that catch the gap fall back to the text snapshot
+    if os.path.exists(directory):
+        os.rename(directory, tmp_directory+'.old')
+    os.rename(tmp_directory, directory)
+    shutil.rmtree(tmp_directory+'.old', ignore_errors=True)
+
+
+def load_columnar_snapshot(filename):
+
+    directory = filename + '.columns'
+
+    try:
+        with open(directory+'/dictionary.json', 'r') as f:
+            columns = json.load(f)
+
+        # stale: the text snapshot has been updated since it was converted
+        if columns['source_mtime'] != os.path.getmtime(filename):
+            return None
+
+        for field in columnar_fields:
+            columns[field] = numpy.load(directory+'/'+field+'.npy', mmap_mode='r')
+    except (OSError, ValueError, KeyError):
+        return None
+
+    return add_columnar_indexes(columns)
+
+
+def columnar_record(columns, row):
+
+    return {'fileset': columns['filesets'][columns['fileset'][row]],
+            'type': columnar_types[columns['type'][row]],
+            'name': columns['names'][columns['name'][row]],
+            'used_gib': float(columns['used_gib'][row]),
+            'quota_gib': float(columns['quota_gib'][row]),
+            'used_files': int(columns['used_files'][row]),
+            'quota_files': int(columns['quota_files'][row]),
+            }
+
+
+def read_columnar_usage(columns, this_user, group, usage_details, user_filesets):
+
+    # find the filesets this user (or group) has rows in, then only build those filesets
+    if this_user is not None:
+        members = [this_user]
+    else:
+        members = group['members']
+    member_codes = [columns['name_codes'][member] for member in members if member in columns['name_codes']]
 
+    mine = columns['usage_rows'] & numpy.isin(columns['name'], member_codes)
+    fileset_codes = numpy.unique(columns['fileset'][mine])
+
+    # and the group's pi filesets, which add_missing_pi_filesets will list
+    pi_codes = [columns['fileset_codes'][fileset] for fileset in columns['pi_index'].get(group['name'], [])]
+    fileset_codes = numpy.union1d(fileset_codes, numpy.array(pi_codes, dtype=numpy.int32))
+
+    for row in numpy.nonzero(columns['usage_rows'] & numpy.isin(columns['fileset'], fileset_codes))[0]:
+        user_data = columnar_record(columns, row)
+
+        if user_data['fileset'] not in usage_details.keys():
+            usage_details[user_data['fileset']] = {}
+        usage_details[user_data['fileset']][user_data['name']] = user_data
+
+    for code in numpy.unique(columns['fileset'][mine]):
+        user_filesets.add(columns['filesets'][code])
+
+
+def columnar_summary_quotas(columns, filesets):
+
+    fileset_codes = [columns['fileset_codes'][fileset] for fileset in filesets if fileset in columns['fileset_codes']]
+    rows = numpy.nonzero(columns['summary_rows'] & numpy.isin(columns['fileset'], fileset_codes))[0]
+
+    return [columnar_record(columns, row) for row in rows]
 
 ## OVERALL USAGE AND QUOTA COLLECTION
-def collect_usage_details(filesystems, this_user, group, cluster):
+def collect_usage_details(filesystems, this_user, group, cluster, snapshot_date=None, warnings=None):
 
     # collects all usage details for gpfs systems
     user_based_usage = {}
     # collects list of all filesets and filesets where this_user has data
     user_filesets = set()
+    # pi filesets per group in the snapshots read for this call
+    pi_filesets = {}
 
     for filesystem in filesystems:
         if filesystem in gpfs_device_names.keys():
             read_mmrepquota_gpfs(filesystem, this_user, cluster, group,
-                                 user_based_usage, user_filesets)
+                                 user_based_usage, user_filesets, pi_filesets, snapshot_date, warnings)
 
         elif filesystem in ['palmer', 'roberts', 'weston']:
-            read_user_details_vast(filesystem, this_user, group, user_based_usage, user_filesets)
+            read_user_details_vast(filesystem, this_user, group, user_based_usage, user_filesets, pi_filesets,
+                                   snapshot_date)
         else:
-            print('Unknown filesystem, '+filesystem+', on '+cluster)
+            warn('Unknown filesystem, '+filesystem+', on '+cluster, warnings)
+
+    add_missing_pi_filesets(user_filesets, group, user_based_usage, filesystems, pi_filesets)
 
     return user_based_usage, list(user_filesets)
 
 
-def collect_quota_data(filesets, filesystems, user, group, cluster, is_live):
+def collect_quota_data(filesets, filesystems, user, group, cluster, is_live, debug=False, snapshot_date=None,
+                       warnings=None):
 
-    global debug
     if debug:
-        print("**Debug Output Enabled**")
+        warn("**Debug Output Enabled**", warnings)
+
+    # archived snapshots are never live
+    if snapshot_date is not None:
+        is_live = False
+
+    # non-interactive callers have a budget of live queries, past it they get the snapshot
+    rate_limit = not debug and not is_interactive()
 
     output = ['', '', '']
     for filesystem in filesystems:
@@ -534,48 +1429,87 @@ def collect_quota_data(filesets, filesystems, user, group, cluster, is_live):
                 if debug:
                     # if debug mode, force live query
                     quota_data_gpfs(filesets, filesystem,
-                                    user, group, cluster, output, is_live=True)
+                                    user, group, cluster, output, is_live=True, debug=debug)
                 else:
                     #if not debug mode, fail over silently
                     try:
                         quota_data_gpfs(filesets, filesystem,
-                                             user, group, cluster, output, is_live=True)
+                                             user, group, cluster, output, is_live=True, debug=debug,
+                                             rate_limit=rate_limit)
                     except:
                         is_live = False
                         quota_data_gpfs(filesets, filesystem,
                                              user, group, cluster, output, is_live=False)
             else:
-                quota_data_gpfs(filesets, filesystem, user, group, cluster, output, is_live=False)
+                quota_data_gpfs(filesets, filesystem, user, group, cluster, output, is_live=False,
+                                snapshot_date=snapshot_date)
 
         elif filesystem in ['palmer', 'roberts', 'weston']:
             # vast doesn't (yet?) return live data so just return cached data
-             quota_data_vast(filesystem, user, group, cluster, output)
+             quota_data_vast(filesystem, user, group, cluster, output, snapshot_date=snapshot_date)
 
-    if is_live:
-        file = open('/tmp/.%sgqlc' % user, 'wb')
-        pickle.dump(output, file)
-        file.close()
+    if is_live and user is not None:
+        write_localcache_quota_data(user, output)
 
-    return output
+    # is_live is False if any of the data came from snapshots instead
+    return output, is_live
 
 ## USER BREAKDOWN ##
-def compile_usage_details(filesets, group, user_based_usage):
+details_sort_keys = {'usage': 'used_gib',
+                     'files': 'used_files'}
+
+def select_usage_details(fileset_usage, users, top=None, sort_by=None):
+
+    # with --top, pick the rows with a partial selection instead of sorting everyone
+    if sort_by is None:
+        sort_by = 'usage' if top else 'name'
+
+    if sort_by == 'name':
+        if top:
+            selected = heapq.nsmallest(top, users)
+        else:
+            selected = sorted(users)
+    else:
+        key = details_sort_keys[sort_by]
+        if top:
+            selected = heapq.nlargest(top, users, key=lambda user: fileset_usage[user][key])
+        else:
+            selected = sorted(users, key=lambda user: fileset_usage[user][key], reverse=True)
+
+    # roll everyone that didn't make the cut into one line
+    others = None
+    if top and len(users) > len(selected):
+        shown = set(selected)
+        others = {'count': 0, 'used_gib': 0, 'used_files': 0}
+        for user in users:
+            if user not in shown:
+                others['count'] += 1
+                others['used_gib'] += fileset_usage[user]['used_gib']
+                others['used_files'] += fileset_usage[user]['used_files']
+
+    return selected, others
+
+
+def compile_usage_details(filesets, group, user_based_usage, top=None, sort_by=None):
     output = ['', '']
 
     for fileset in sorted(filesets):
         section = []
 
         if is_pi_fileset(fileset):
-            for user in sorted(user_based_usage[fileset].keys()):
-                section.append(format_for_details(fileset, user, user_based_usage[fileset][user]))
-            output.append('\n'.join(section))
-
+            users = list(user_based_usage[fileset].keys())
         else:
-            for group_member in sorted(group['members']):
-                if group_member not in user_based_usage[fileset].keys():
-                    continue
-                else:
-                    section.append(format_for_details(fileset, group_member, user_based_usage[fileset][group_member]))
+            users = [group_member for group_member in group['members']
+                     if group_member in user_based_usage[fileset].keys()]
+
+        selected, others = select_usage_details(user_based_usage[fileset], users, top, sort_by)
+        for user in selected:
+            section.append(format_for_details(fileset, user, user_based_usage[fileset][user]))
+        if others is not None:
+            section.append(format_for_details(fileset, 'others ({0})'.format(others['count']), others))
+
+        if is_pi_fileset(fileset):
+            output.append('\n'.join(section))
 
         section = '\n'.join(section)
 
@@ -627,8 +1561,8 @@ def format_for_summary(quotas, cluster):
 
 def check_limits(summary_data):
 
-    at_limit = {'byte': 0,
-                'file': 0}
+    at_limit = {'byte': False,
+                'file': False}
 
     # if you can, avoid the possiblity of dividing by zero
     if summary_data['quota_gib'] == 0:
@@ -636,9 +1570,9 @@ def check_limits(summary_data):
     if summary_data['quota_files'] == 0:
         return at_limit
 
-    if (summary_data['quota_gib']-summary_data['used_gib'])/float(summary_data['quota_gib']) <= 0.05:
+    if (summary_data['quota_gib']-summary_data['used_gib'])/float(summary_data['quota_gib']) <= limit_threshold:
         at_limit['byte'] = True
-    if (summary_data['quota_files']-summary_data['used_files'])/float(summary_data['quota_files']) <= 0.05:
+    if (summary_data['quota_files']-summary_data['used_files'])/float(summary_data['quota_files']) <= limit_threshold:
         at_limit['file'] = True
 
     return at_limit
@@ -676,7 +1610,7 @@ def print_cli_output(details_data, summary_data, group, timestamp, is_live, clus
 
     header = "This script shows information about your quotas on {0}.\n".format(cluster)
     header += "If you plan to poll this sort of information extensively,\n"
-    header += "please contact us for help at hpc@yale.edu\n"
+    header += "please use getquota --watch or contact us for help at hpc@yale.edu\n"
 
     print(header)
 
@@ -715,48 +1649,304 @@ def print_cli_output(details_data, summary_data, group, timestamp, is_live, clus
         print('\n'.join(warnings))
         print('!!!!!!!!!!!!!!!!!!!!!!!!!!!')
 
-### MAIN ###
+### DIRECTORY DRILLDOWN
 
-if (__name__ == '__main__'):
-    global debug
+def drilldown_starfish(path, depth, deadline):
 
-    user, group, cluster, is_me, print_format = get_args()
-    group['name'] = grp.getgrgid(group['id']).gr_name
+    # starfish has already aggregated sizes and file counts per directory
+    query = 'sf query {0} --type d --maxdepth {1} --format "full_path rec_aggrs.size rec_aggrs.files" --csv -d , -H'
+    result = subprocess.check_output([query.format(shlex.quote(path), depth)], shell=True, encoding='UTF-8',
+                                     stderr=subprocess.DEVNULL, timeout=max(deadline-time.time(), 1))
 
-    filesystems = {
-                   'grace': ['gibbs', 'palmer'],
-                   'mccleary': ['gibbs', 'palmer'],
-                   'milgram': ['milgram'],
-                   'misha': ['radev'],
-                   }
+    usage = {}
+    for line in result.replace('"', '').split('\n'):
+        if not line:
+            continue
+        directory, size, files = line.rsplit(',', 2)
+        usage[directory.rstrip('/')] = {'used_gib': int(size)/1024/1024/1024,
+                                        'used_files': int(files)}
+
+    return usage
+
+
+def drilldown_walk(path, depth, deadline):
+
+    # per-directory totals, with everything below depth charged to its ancestor at depth
+    direct = {}
+    seen_inodes = set()
+    lock = threading.Lock()
+    directories = queue.Queue()
+    finished = {'complete': True}
+
+    def walk_directory(directory, key):
+        used_bytes = 0
+        used_files = 0
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    # a single huge directory can take longer than the whole deadline
+                    if time.time() >= deadline:
+                        finished['complete'] = False
+                        break
+
+                    try:
+                        info = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+
+                    if stat.S_ISDIR(info.st_mode):
+                        used_files += 1
+                        if key.count('/') - path.count('/') < depth:
+                            directories.put((entry.path, entry.path))
+                        else:
+                            directories.put((entry.path, key))
+                        continue
+
+                    # only count hard-linked files once
+                    if info.st_nlink > 1:
+                        with lock:
+                            if (info.st_dev, info.st_ino) in seen_inodes:
+                                continue
+                            seen_inodes.add((info.st_dev, info.st_ino))
+                    used_files += 1
+                    used_bytes += info.st_blocks*512
+        except OSError:
+            pass
+
+        with lock:
+            if key not in direct:
+                direct[key] = {'used_gib': 0, 'used_files': 0}
+            direct[key]['used_gib'] += used_bytes/1024/1024/1024
+            direct[key]['used_files'] += used_files
+
+    def worker():
+        while True:
+            item = directories.get()
+            if item is None:
+                break
+            directory, key = item
+            if time.time() < deadline:
+                walk_directory(directory, key)
+            else:
+                finished['complete'] = False
+            directories.task_done()
+
+    threads = [threading.Thread(target=worker, daemon=True) for i in range(drilldown_threads)]
+    for thread in threads:
+        thread.start()
+
+    directories.put((path, path))
+    directories.join()
+
+    # one sentinel per worker so none outlive this path
+    for thread in threads:
+        directories.put(None)
+    for thread in threads:
+        thread.join()
+
+    # roll the per-directory totals up into their parents
+    usage = {}
+    for directory, data in direct.items():
+        parent = directory
+        while True:
+            if parent not in usage:
+                usage[parent] = {'used_gib': 0, 'used_files': 0}
+            usage[parent]['used_gib'] += data['used_gib']
+            usage[parent]['used_files'] += data['used_files']
+            if parent == path:
+                break
+            parent = os.path.dirname(parent)
+
+    return usage, finished['complete']
+
+
+def format_for_drilldown(directory, usage):
+
+    # directory, bytes, file count
+    return '{0:60.59}{1:12.0f}{2:14,}'.format(directory, usage['used_gib'], usage['used_files'])
+
+
+def drilldown(user, group, cluster, depth, top):
+
+    if cluster not in drilldown_paths:
+        sys.exit('Directory drilldown is not available on '+cluster)
+
+    header = '{0:60}{1:12}{2:14}\n'.format('Directory', 'Usage (GiB)', ' File Count')
+    header += '{0:60}{1:12}{2:14}'.format('-'*59, '-'*12, ' '+'-'*13)
+
+    for path in drilldown_paths[cluster]:
+        path = os.path.normpath(path.format(group['name'], user or ''))
+        if not os.path.isdir(path):
+            continue
+
+        complete = True
+        usage = None
+        if shutil.which('sf') is not None:
+            try:
+                usage = drilldown_starfish(path, depth, time.time() + drilldown_deadline)
+            except (subprocess.SubprocessError, ValueError):
+                usage = None
+        if not usage:
+            # its own deadline, a starfish query that timed out must not leave the walk no time at all
+            usage, complete = drilldown_walk(path, depth, time.time() + drilldown_deadline)
+
+        total = usage.pop(path, {'used_gib': 0, 'used_files': 0})
+        print('## Usage under {0}: {1:.0f} GiB, {2:,} files'.format(path, total['used_gib'], total['used_files']))
+        if not complete:
+            print('(incomplete, stopped after {0} seconds)'.format(drilldown_deadline))
+
+        for sort_by in ['usage', 'files']:
+            key = details_sort_keys[sort_by]
+            print('\n### Largest directories by {0}'.format(sort_by))
+            print(header)
+            for directory in heapq.nlargest(top, usage, key=lambda directory: usage[directory][key]):
+                print(format_for_drilldown(directory, usage[directory]))
+        print('')
+
+### WATCH MODE
+
+def snapshot_files(filesystems, cluster):
+
+    # base names, snapshot_mtimes and the inotify match also cover their compressed versions
+    files = []
+    for filesystem in filesystems:
+        if filesystem in gpfs_device_names.values():
+            files.append('/gpfs/'+filesystem + '/.mmrepquota/current')
+
+        elif filesystem in vast_paths.keys():
+            quota_dir = vast_paths[filesystem] + '.quotas/'
+            files += [quota_dir+'current', quota_dir+cluster+'_current',
+                      quota_dir+'scratch.details', quota_dir+'pi.details']
+
+    return files
+
+
+def snapshot_mtimes(files):
+
+    # resolved on every check, a snapshot may switch between plain and compressed
+    mtimes = {}
+    for filename in files:
+        path = snapshot_path(filename)
+        try:
+            mtimes[filename] = (path, os.stat(path).st_mtime)
+        except (OSError, TypeError):
+            mtimes[filename] = None
+
+    return mtimes
+
+
+def inotify_snapshots(files):
+
+    # returns an inotify fd watching the snapshot directories, or None if inotify isn't available
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+
+    for directory in set(os.path.dirname(filename) for filename in files):
+        if os.path.isdir(directory):
+            libc.inotify_add_watch(fd, directory.encode(), IN_CLOSE_WRITE | IN_MOVED_TO)
+
+    return fd
+
+
+def wait_for_snapshot_change(files, inotify_fd, mtimes):
+
+    names = set(os.path.basename(filename)+extension for filename in files for extension in snapshot_extensions)
+    last_check = time.time()
+
+    while True:
+        timeout = max(0, watch_poll_interval - (time.time() - last_check))
+        if inotify_fd is not None:
+            ready = select.select([inotify_fd], [], [], timeout)[0]
+        else:
+            ready = []
+            time.sleep(timeout)
+
+        if ready:
+            # struct inotify_event: int wd, uint32 mask, uint32 cookie, uint32 len, char name[len]
+            events = os.read(inotify_fd, 4096)
+            offset = 0
+            while offset < len(events):
+                wd, mask, cookie, length = struct.unpack_from('iIII', events, offset)
+                name = events[offset+16:offset+16+length].rstrip(b'\0').decode()
+                offset += 16 + length
+                if name in names:
+                    return snapshot_mtimes(files)
+
+        # inotify only sees changes made on this node, so compare mtimes every poll interval too,
+        # even while unrelated files in the same directories keep generating events
+        if time.time() - last_check >= watch_poll_interval:
+            last_check = time.time()
+            new_mtimes = snapshot_mtimes(files)
+            if new_mtimes != mtimes:
+                return new_mtimes
+
+
+def watch(user, group, cluster, filesystems, is_me, print_format, top=None, sort_by=None, debug=False):
+
+    files = snapshot_files(filesystems, cluster)
+    inotify_fd = inotify_snapshots(files)
+    mtimes = snapshot_mtimes(files)
+    last_live = 0
+
+    while True:
+        # rate-limit live queries, in between only re-read the updated snapshots
+        is_live = is_me and time.time() - last_live >= watch_live_interval
+        if is_live:
+            last_live = time.time()
+
+        # render into a buffer first: a snapshot caught mid-write fails to parse, in which case
+        # the previous output stays up until the next change
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output):
+                report(user, group, cluster, filesystems, is_live, print_format, top, sort_by, debug)
+        except Exception as e:
+            if debug:
+                print('report failed, keeping the previous output:', repr(e), file=sys.stderr)
+        else:
+            if sys.stdout.isatty():
+                print('\033[H\033[J', end='')
+            print(output.getvalue(), end='')
+            sys.stdout.flush()
+
+        mtimes = wait_for_snapshot_change(files, inotify_fd, mtimes)
+
+
+def snapshot_timestamp(filesystems, snapshot_date=None):
+
+    filename = snapshot_path('/gpfs/'+filesystems[0] + '/.mmrepquota/current', snapshot_date)
+    if filename is None:
+        return 'unavailable'
+
+    return time.strftime('%b %d %Y %H:%M', time.localtime(os.path.getmtime(filename)))
+
+
+def report(user, group, cluster, filesystems, is_live, print_format, top=None, sort_by=None, debug=False,
+           snapshot_date=None):
 
-    # check if user in ycga group
-    if cluster in ['mccleary'] and 10266 in os.getgroups():
-        filesystems[cluster].append('ycga')
-    
     # usage details
-    timestamp = time.strftime('%b %d %Y %H:%M', time.localtime(os.path.getmtime('/gpfs/'+filesystems[cluster][0]
-                                                                                + '/.mmrepquota/current')))
+    timestamp = snapshot_timestamp(filesystems, snapshot_date)
 
-    get_group_members(group, cluster)
+    user_based_usage, user_filesets = collect_usage_details(filesystems, user,
+                                                               group, cluster, snapshot_date)
 
-    user_based_usage, user_filesets = collect_usage_details(filesystems[cluster], user,
-                                                               group, cluster)
-    # add_missing_pi_filesets(user_filesets, group) # CURRENTLY BROKEN 
-    
-    details_data = compile_usage_details(user_filesets, group, user_based_usage)
-    
-    is_live = False
-    if is_me:
-        is_live = True
+    details_data = compile_usage_details(user_filesets, group, user_based_usage, top, sort_by)
 
     # usage and quota summary
     summary_data = None
 #    if is_me:
 #        summary_data = localcache_quota_data(user)
     if summary_data is None or debug:
-        summary_data = collect_quota_data(user_filesets, filesystems[cluster],
-                                          user, group, cluster, is_live)
+        summary_data, is_live = collect_quota_data(user_filesets, filesystems,
+                                                   user, group, cluster, is_live, debug, snapshot_date)
 
     # print
     if print_format == 'cli':
@@ -765,3 +1955,120 @@ if (__name__ == '__main__'):
         get_quota_status(summary_data)
     else:
         sys.exit('unknown print format: ', print_format)
+
+### LIBRARY API
+#
+# For in-process callers (job prologs, seff-array, ...):
+#
+#   import getquota
+#   summary = getquota.get_summary(user='netid')
+#   details = getquota.get_details(group='lab', active_users_only=True)
+#
+# Parsed snapshots and group lookups are cached in the module, so long-running callers
+# only pay for them once per snapshot update.
+
+def prepare_query(user=None, group=None, cluster=None, active_users_only=False, snapshot_date=None, warnings=None):
+
+    user, group = lookup_entity(user, group)
+    if cluster is None:
+        cluster = get_cluster()
+    filesystems = get_filesystems(cluster)
+
+    get_group_members(group, cluster, active_users_only)
+    user_based_usage, user_filesets = collect_usage_details(filesystems, user, group, cluster, snapshot_date,
+                                                            warnings)
+
+    return user, group, cluster, filesystems, user_based_usage, user_filesets
+
+
+def get_details(user=None, group=None, cluster=None, active_users_only=False, snapshot_date=None):
+    """Per-user usage in every fileset the user (or group) has data in.
+
+    Returns a dict with the user, group name, cluster, snapshot timestamp, 'usage', a list of
+    {'fileset', 'user', 'used_gib', 'used_files'} records, and 'warnings', messages like an unavailable
+    filesystem that the command line prints. snapshot_date (YYYY-MM-DD) reads the archived snapshots
+    of that day. Raises KeyError for unknown users or groups.
+    """
+
+    warnings = []
+    user, group, cluster, filesystems, user_based_usage, user_filesets = prepare_query(user, group, cluster,
+                                                                                      active_users_only,
+                                                                                      snapshot_date, warnings)
+    usage = []
+    for fileset in sorted(user_filesets):
+        for name in sorted(user_based_usage[fileset].keys()):
+            if is_pi_fileset(fileset) or name in group['members']:
+                usage.append({'fileset': fileset,
+                              'user': name,
+                              'used_gib': user_based_usage[fileset][name]['used_gib'],
+                              'used_files': user_based_usage[fileset][name]['used_files'],
+                              })
+
+    return {'user': user,
+            'group': group['name'],
+            'cluster': cluster,
+            'timestamp': snapshot_timestamp(filesystems, snapshot_date),
+            'usage': usage,
+            'warnings': warnings,
+            }
+
+
+def get_summary(user=None, group=None, cluster=None, active_users_only=False, is_live=False, debug=False,
+                snapshot_date=None):
+    """Usage, quotas and limit warnings for the user's home, project, scratch and pi filesets.
+
+    Returns a dict with the user, group name, cluster, snapshot timestamp and 'quotas',
+    a list of {'fileset', 'type', 'name', 'used_gib', 'quota_gib', 'used_files', 'quota_files',
+    'at_limit'} records, with 'type' one of USR, GRP or FILESET and 'at_limit' {'byte': bool, 'file': bool}.
+    active_users_only limits a group's members to active users, as -a does on the command line. is_live queries GPFS with mmlsquota
+    instead of reading the snapshots; without a user only the group and pi fileset quotas are queried.
+    The returned 'is_live' is False when the snapshots were used anyway (query failed or rate limited).
+    snapshot_date (YYYY-MM-DD) reads the archived snapshots of that day. 'warnings' lists the messages
+    the command line prints, e.g. an unavailable filesystem. Raises KeyError for unknown users or groups.
+    """
+
+    warnings = []
+    user, group, cluster, filesystems, user_based_usage, user_filesets = prepare_query(user, group, cluster,
+                                                                                      active_users_only,
+                                                                                      snapshot_date, warnings)
+
+    summary_data, is_live = collect_quota_data(user_filesets, filesystems, user, group, cluster, is_live, debug,
+                                               snapshot_date, warnings)
+
+    quotas = []
+    for quota in summary_data:
+        if quota:
+            quota = dict(quota)
+            quota['at_limit'] = check_limits(quota)
+            quotas.append(quota)
+
+    return {'user': user,
+            'group': group['name'],
+            'cluster': cluster,
+            'timestamp': snapshot_timestamp(filesystems, snapshot_date),
+            'is_live': is_live,
+            'quotas': quotas,
+            'warnings': warnings,
+            }
+
+### MAIN ###
+
+if (__name__ == '__main__'):
+
+    user, group, cluster, is_me, print_format, args = get_args()
+    filesystems = get_filesystems(cluster)
+
+    if args.drilldown:
+        drilldown(user, group, cluster, args.depth, args.top or 10)
+        sys.exit()
+
+    get_group_members(group, cluster, args.active_users)
+
+    if args.watch:
+        try:
+            watch(user, group, cluster, filesystems, is_me, print_format, args.top, args.sort, args.debug)
+        except KeyboardInterrupt:
+            pass
+    else:
+        report(user, group, cluster, filesystems, is_me, print_format, args.top, args.sort, args.debug,
+               args.snapshot_date)
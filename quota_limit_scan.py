@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# Cluster-wide scan for USR, GRP and FILESET quotas that are at or near their limits.
+# Meant to run from cron on a monitor node, next to getquota.py.
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import getquota
+
+# entities only drop off the notified list once they have this much headroom again,
+# so a lab hovering around the limit is not re-notified on every run
+clear_threshold = 0.10
+
+# kept out of world-writable directories, where anyone could plant the state (or a symlink) first
+state_file = '/var/lib/quota_limit_scan/state'
+
+
+def get_args():
+
+    parser = argparse.ArgumentParser(
+                    prog = 'quota_limit_scan',
+                    description = 'Scan all GPFS and VAST quota snapshots for entities at or near their limits',
+                    epilog = 'Prints entities that need to be notified, one per line')
+
+    parser.add_argument('-s', '--state', default=state_file,
+                        help='hysteresis state file (default: %(default)s)')
+    parser.add_argument('-a', '--all', action='store_true',
+                        help='list every entity over the threshold, not only newly notified ones')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='do not update the state file')
+
+    return parser.parse_args()
+
+
+def headroom(used, limit):
+
+    # avoid the possiblity of dividing by zero, entities without a limit never fill up
+    if limit == 0:
+        return 1.0
+
+    return (limit-used)/float(limit)
+
+
+def scan_quota(quota, over, cleared):
+
+    key = '{0}:{1}:{2}'.format(quota['fileset'], quota['type'], quota['name'])
+
+    byte_headroom = headroom(quota['used_gib'], quota['quota_gib'])
+    file_headroom = headroom(quota['used_files'], quota['quota_files'])
+
+    if min(byte_headroom, file_headroom) <= clear_threshold:
+        cleared.discard(key)
+
+    at_limit = getquota.check_limits(quota)
+    if at_limit['byte'] or at_limit['file']:
+        over[key] = {'fileset': quota['fileset'],
+                     'type': quota['type'],
+                     'name': quota['name'],
+                     'byte': bool(at_limit['byte']),
+                     'file': bool(at_limit['file']),
+                     'used_gib': quota['used_gib'],
+                     'quota_gib': quota['quota_gib'],
+                     'used_files': quota['used_files'],
+                     'quota_files': quota['quota_files'],
+                     }
+
+
+def scan_columns(columns, over, cleared):
+
+    # vectorized version of the checks in scan_quota, which then only sees the rows close to a limit
+    with getquota.numpy.errstate(divide='ignore', invalid='ignore'):
+        byte_headroom = getquota.numpy.where(columns['quota_gib'] > 0,
+                                             (columns['quota_gib']-columns['used_gib'])/columns['quota_gib'], 1.0)
+        file_headroom = getquota.numpy.where(columns['quota_files'] > 0,
+                                             (columns['quota_files']-columns['used_files'])/columns['quota_files'], 1.0)
+
+    near = getquota.numpy.minimum(byte_headroom, file_headroom) <= max(clear_threshold, getquota.limit_threshold)
+
+    for row in getquota.numpy.nonzero(near)[0]:
+        scan_quota(getquota.columnar_record(columns, row), over, cleared)
+
+
+def scan_snapshot(filename, filesystem, records, over, cleared):
+
+    columns = None
+    if getquota.numpy is not None:
+        columns = getquota.load_columnar_snapshot(filename)
+
+    if columns is not None:
+        scan_columns(columns, over, cleared)
+    else:
+        for quota in records(filename, filesystem):
+            scan_quota(quota, over, cleared)
+
+
+def scan_gpfs(filesystem, over, cleared, scanned):
+
+    filename = getquota.snapshot_path('/gpfs/'+filesystem + '/.mmrepquota/current')
+    if filename is None:
+        print("%s is not available at the moment" % filesystem, file=sys.stderr)
+        return
+
+    scan_snapshot(filename, filesystem, getquota.gpfs_quota_records, over, cleared)
+    scanned.add(filesystem+':')
+
+
+def scan_vast(filesystem, over, cleared, scanned):
+
+    quota_dir = getquota.vast_paths[filesystem] + '.quotas/'
+
+    # current holds everything but the home quotas, which are in <cluster>_current
+    prefixes = {'current': filesystem+':',
+                'mccleary_current': filesystem+':home.mccleary:',
+                'grace_current': filesystem+':home.grace:',
+                }
+
+    for basename, prefix in prefixes.items():
+        filename = getquota.snapshot_path(quota_dir+basename)
+        if filename is None:
+            continue
+
+        scan_snapshot(filename, filesystem, getquota.vast_quota_records, over, cleared)
+        scanned.add(prefix)
+
+
+def snapshot_prefix(key):
+
+    # the prefix scan_gpfs or scan_vast records once the snapshot a state key comes from is scanned
+    filesystem, fileset = key.split(':')[:2]
+    if filesystem in getquota.vast_paths and fileset.startswith('home.'):
+        return filesystem+':'+fileset+':'
+
+    return filesystem+':'
+
+
+def read_state(filename):
+
+    if not os.path.exists(filename):
+        return {}
+
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        # a truncated state file only costs one round of repeated notifications
+        return {}
+
+
+def write_state(filename, state):
+
+    # a new, uniquely named file renamed over the old state, so nothing planted in the directory is followed
+    directory = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(directory, mode=0o755, exist_ok=True)
+
+    fd, tmp_filename = tempfile.mkstemp(prefix='.'+os.path.basename(filename)+'.', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.unlink(tmp_filename)
+        raise
+
+
+def format_entity(entity):
+
+    limits = []
+    if entity['byte']:
+        limits.append('bytes {0:.0f}/{1:.0f} GiB'.format(entity['used_gib'], entity['quota_gib']))
+    if entity['file']:
+        limits.append('files {0:,}/{1:,}'.format(entity['used_files'], entity['quota_files']))
+
+    return '{0:30.29}{1:8}{2:14.13}{3}'.format(entity['fileset'], entity['type'], entity['name'],
+                                              ', '.join(limits))
+
+
+if (__name__ == '__main__'):
+
+    args = get_args()
+
+    state = read_state(args.state)
+
+    # over holds every entity at its limit, keyed to deduplicate rows across snapshots;
+    # cleared starts as everything previously notified and loses whatever is still close to its limit,
+    # scanned holds the prefixes of the snapshots that could be read
+    over = {}
+    cleared = set(state.keys())
+    scanned = set()
+
+    for filesystem in sorted(set(getquota.gpfs_device_names.values())):
+        scan_gpfs(filesystem, over, cleared, scanned)
+    for filesystem in getquota.vast_paths.keys():
+        scan_vast(filesystem, over, cleared, scanned)
+
+    # entities in a snapshot that is missing right now keep their state until it is back
+    now = int(time.time())
+    for key in cleared:
+        if snapshot_prefix(key) in scanned:
+            del state[key]
+
+    for key in sorted(over.keys()):
+        if args.all or key not in state:
+            print(format_entity(over[key]))
+        if key not in state:
+            state[key] = now
+
+    if not args.dry_run:
+        write_state(args.state, state)
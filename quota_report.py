@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# Admin reports over a whole GPFS mmrepquota snapshot: usage per fileset and top users.
+import argparse
+import sys
+
+import getquota
+
+
+def get_args():
+
+    parser = argparse.ArgumentParser(
+                    prog = 'quota_report',
+                    description = 'Usage totals per fileset and top users from the mmrepquota snapshots')
+
+    parser.add_argument('-f', '--filesystem', default='gibbs', choices=sorted(set(getquota.gpfs_device_names.values())),
+                        help='GPFS filesystem to report on (default: %(default)s)')
+    parser.add_argument('-t', '--top', type=int, default=100,
+                        help='number of users to list (default: %(default)s)')
+    parser.add_argument('-s', '--sort', choices=['usage', 'files'], default='usage',
+                        help='rank filesets and users by usage or files (default: %(default)s)')
+
+    return parser.parse_args()
+
+
+def load_columns(filesystem):
+
+    filename = getquota.snapshot_path('/gpfs/'+filesystem + '/.mmrepquota/current')
+    if filename is None:
+        sys.exit("%s is not available at the moment" % filesystem)
+
+    # converted snapshot if it is current, otherwise parse the text snapshot
+    columns = getquota.load_columnar_snapshot(filename)
+    if columns is None:
+        columns = getquota.columns_from_records(getquota.gpfs_quota_records(filename, filesystem))
+
+    return columns
+
+
+def group_by(columns, field):
+
+    # sum USR usage and file counts per fileset or per user
+    rows = columns['usage_rows']
+    codes = columns[field][rows]
+    size = len(columns[field+'s'])
+
+    return (getquota.numpy.bincount(codes, weights=columns['used_gib'][rows], minlength=size),
+            getquota.numpy.bincount(codes, weights=columns['used_files'][rows], minlength=size))
+
+
+def print_ranking(title, labels, used_gib, used_files, sort_by, top):
+
+    ranked = used_gib if sort_by == 'usage' else used_files
+    top = min(top, len(ranked))
+    selected = getquota.numpy.argpartition(-ranked, top-1)[:top] if top else []
+    selected = sorted(selected, key=lambda code: -ranked[code])
+
+    print('## {0}'.format(title))
+    print('{0:30}{1:12}{2:14}'.format('', 'Usage (GiB)', ' File Count'))
+    for code in selected:
+        print('{0:30.29}{1:12.0f}{2:14,}'.format(labels[code], used_gib[code], int(used_files[code])))
+    print('')
+
+
+if (__name__ == '__main__'):
+
+    if getquota.numpy is None:
+        sys.exit('numpy is required for quota reports')
+
+    args = get_args()
+    columns = load_columns(args.filesystem)
+
+    used_gib, used_files = group_by(columns, 'fileset')
+    print_ranking('Usage per fileset on '+args.filesystem, columns['filesets'], used_gib, used_files,
+                  args.sort, len(columns['filesets']))
+
+    used_gib, used_files = group_by(columns, 'name')
+    print_ranking('Top {0} users on {1}'.format(args.top, args.filesystem), columns['names'], used_gib, used_files,
+                  args.sort, args.top)